@@ -0,0 +1,75 @@
+import functools
+import threading
+
+class RouteClass():
+    def __init__(self, limit, queue, wait, budget):
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.queue = queue
+        self.waiting = 0
+        self.wait = wait
+        self.budget = budget
+
+    # Take a slot, queueing for one only while fewer than queue requests are already waiting, as each holds a server thread
+    def admit(self):
+        if self.semaphore.acquire(blocking=False):
+            return True
+        with self.lock:
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+        try:
+            return self.semaphore.acquire(timeout=self.wait)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+# Limits how many requests of each priority class run at once, so expensive routes can't take every thread
+class AdmissionControl():
+    def __init__(self, timeBudget, retryAfter=5):
+        self.timeBudget = timeBudget
+        self.retryAfter = retryAfter
+        self.classes = {}
+
+    # Add a class of routes, with the number that may run at once, the number that may queue, the seconds a request may queue and its time budget in milliseconds
+    def addClass(self, name, limit, queue, wait, budget):
+        self.classes[name] = RouteClass(limit, queue, wait, budget)
+
+    # Most server threads the limited routes can hold at once, running or queued
+    def getReservedThreads(self):
+        return sum(routeClass.limit + routeClass.queue for routeClass in self.classes.values())
+
+    def getBusyResponse(self):
+        return {
+            'status': 503,
+            'message': 'Server is busy, try again later'
+        }, 503, {'Retry-After': str(self.retryAfter)}
+
+    # Decorator admitting a route under a class, rejecting it with a 503 if the queue is full, it queued too long or it ran out of time
+    def limit(self, name):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                routeClass = self.classes[name]
+                if not routeClass.admit():
+                    return self.getBusyResponse()
+                try:
+                    with self.timeBudget(routeClass.budget) as budget:
+                        try:
+                            result = fn(*args, **kwargs)
+                        except TimeoutError:
+                            return self.getBusyResponse()
+                        except Exception:
+                            if budget['timedOut']:
+                                return self.getBusyResponse()
+                            raise
+
+                    # Routes turn database errors into their own responses, so check if the budget ran out
+                    if budget['timedOut']:
+                        return self.getBusyResponse()
+                    return result
+                finally:
+                    routeClass.semaphore.release()
+            return wrapper
+        return decorator
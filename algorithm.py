@@ -1,8 +1,63 @@
 from prettytable import PrettyTable
 import snscrape.modules.twitter as sntwitter
 import math
+import datetime
 from tweet import Tweet
 
+# Get the fields of a scraped tweet used by the algorithm
+def getTweetInfo(tweet):
+    return {
+        'id': tweet.id,
+        'content': tweet.content,
+        'media': tweet.media,
+        'likes': tweet.likeCount,
+        'retweets': tweet.retweetCount,
+        'replies': tweet.replyCount,
+        'date': tweet.date,
+        'coordinates': tweet.coordinates,
+    }
+
+# Get the name of the file at the end of a media URL, which identifies the media across tweets
+def getMediaName(url):
+    return url.split('?')[0].rstrip('/').split('/')[-1]
+
+# Normalize a scraped photo or video, keeping only the best variant of a video
+def getMediaInfo(m):
+    if isinstance(m, sntwitter.Photo):
+        return {
+            '_id': 'photo:' + getMediaName(m.fullUrl),
+            'type': 'photo',
+            'url': m.fullUrl
+        }
+
+    if isinstance(m, sntwitter.Video):
+        # HLS playlists can't be embedded directly, so pick the highest bitrate of the other variants
+        variants = [v for v in m.variants if v.contentType != 'application/x-mpegURL']
+        if len(variants) == 0:
+            return None
+        best = max(variants, key=lambda v: v.bitrate or 0)
+        return {
+            '_id': 'video:' + getMediaName(m.thumbnailUrl if m.thumbnailUrl is not None else best.url),
+            'type': 'video',
+            'url': best.url,
+            'contentType': best.contentType,
+            'bitrate': best.bitrate,
+            'variants': len(variants)
+        }
+
+    return None
+
+# Get the unique normalized media of a list of scraped tweets
+def extractMedia(tweets):
+    media = {}
+    for tweet in tweets:
+        if tweet['media'] is not None:
+            for m in tweet['media']:
+                mediaInfo = getMediaInfo(m)
+                if mediaInfo is not None:
+                    media[mediaInfo['_id']] = mediaInfo
+    return list(media.values())
+
 def solveAlgo(query, tweets):
 
     # Initialize empty list of tweets
@@ -12,26 +67,16 @@ def solveAlgo(query, tweets):
     blacklist = ['warning', 'watch']
 
     for tweet in tweets:
-        # Calculate the total media attached to the post
+        # Calculate the total media attached to the post, keeping the IDs of the normalized media
         mediaCount = 0
         media = []
         if tweet['media'] is not None:
             for m in tweet['media']:
-                if type(m) == sntwitter.Photo:
-                    mediaCount += 1
-                    media.append({
-                        'type': 'photo',
-                        'url': m.fullUrl
-                    })
-                elif type(m) == sntwitter.Video:
+                if isinstance(m, (sntwitter.Photo, sntwitter.Video)):
                     mediaCount += 1
-                    for videoType in m.variants:
-                        if videoType.contentType != 'application/x-mpegURL':
-                            media.append({
-                                'type': 'video',
-                                'url': videoType.url,
-                                'contentType': videoType.contentType
-                            })
+                    mediaInfo = getMediaInfo(m)
+                    if mediaInfo is not None:
+                        media.append(mediaInfo['_id'])
 
         likes = tweet['likes']
         retweets = tweet['retweets']
@@ -58,16 +103,18 @@ def solveAlgo(query, tweets):
             relatabilityScore = 0
 
         # Default to query location if tweet location is not available
-        location = {
-            'type': 'Point',
-            'coordinates': [float(query.location.split(',')[0]), float(query.location.split(',')[1])]
-        }
+        location = query.point
         if tweet['coordinates'] is not None:
             location = {
                 'type': 'Point',
                 'coordinates': [tweet['coordinates'].longitude, tweet['coordinates'].latitude]
             }
 
+        # Store the date as naive UTC, like the dates read back from the database
+        date = tweet['date']
+        if date.tzinfo is not None:
+            date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
         # Create a new tweet object
         _tweet = Tweet(
             tweet['id'],
@@ -75,7 +122,7 @@ def solveAlgo(query, tweets):
             likes, 
             retweets, 
             replies,
-            tweet['date'],
+            date,
             location,
             tweet['content'],
             media, 
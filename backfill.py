@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+from database import Database
+from rateLimiter import RateLimiter
+from scraper import LimitedSearchScraper
+import algorithm as algo
+import snscrape.base
+from bson.objectid import ObjectId
+from multiprocessing import Pool
+import argparse
+import datetime
+import time
+import os
+import sys
+
+# Load environment variables
+from dotenv import load_dotenv
+load_dotenv()
+
+# Number of tweets scored and saved at a time in each worker
+batchSize = 100
+
+# Each worker process opens its own database connection and rate limiter
+db = None
+limiter = None
+
+def connect():
+    return Database(str(os.environ.get("MONGODB_HOST")), str(os.environ.get("MONGODB_USER")), str(os.environ.get("MONGODB_PASS")), os.environ.get("COLD_STORAGE_DIR"))
+
+# Workers split the scrape rate between them, as they can't share one token bucket across processes
+def initWorker(rate, burst):
+    global db, limiter
+    db = connect()
+    limiter = RateLimiter(rate, burst)
+
+# Split the date range of a query into shards of the given size
+def getShards(query, shardSize):
+    shards = []
+    start = query.startDate
+    while start < query.endDate:
+        end = min(start + shardSize, query.endDate)
+        shards.append((start, end))
+        start = end
+    return shards
+
+# Check if a shard is fully covered by the (start, end) ranges of completed shards, whatever their size
+def isCovered(start, end, completed):
+    for completedStart, completedEnd in sorted(completed):
+        if completedStart > start:
+            break
+        if completedEnd > start:
+            start = completedEnd
+        if start >= end:
+            return True
+    return start >= end
+
+# Scrape, score and save the tweets of one shard, returning why it was skipped or failed if it wasn't completed
+def scrapeShard(query, start, end, maxTweets):
+    startTime = time.time()
+    count = 0
+    tweetList = []
+
+    # Tweets written after the query moved to cold storage would never be read
+    if db.isInColdStorage(query):
+        return start, end, count, 0, 'skipped, the query moved to cold storage'
+
+    # Dates from the database are naive UTC
+    since = int(start.replace(tzinfo=datetime.timezone.utc).timestamp())
+    until = int(end.replace(tzinfo=datetime.timezone.utc).timestamp())
+    searchQuery = f'{query.getKeywordQuery()} since_time:{str(since)} until_time:{str(until)} filter:media filter:has_engagement geocode:"{query.location}"'
+    try:
+        for tweet in LimitedSearchScraper(searchQuery, limiter, query.id).get_items():
+            if maxTweets != 0 and count >= maxTweets:
+                break
+            tweetList.append(algo.getTweetInfo(tweet))
+            count += 1
+
+            if len(tweetList) >= batchSize:
+                db.addMedia(algo.extractMedia(tweetList))
+                db.addTweets(algo.solveAlgo(query, tweetList))
+                tweetList = []
+    except snscrape.base.ScraperException as e:
+        # Keep what was scraped, the shard stays incomplete so it is scraped again on the next run
+        error = f'failed after {str(count)} tweets: {str(e)}'
+    else:
+        error = None
+
+    if len(tweetList) > 0:
+        db.addMedia(algo.extractMedia(tweetList))
+        db.addTweets(algo.solveAlgo(query, tweetList))
+
+    return start, end, count, time.time() - startTime, error
+
+def scrapeShardTask(task):
+    return scrapeShard(*task)
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill the tweets of a query over its whole date range')
+    parser.add_argument('query', help='ID of the active or archived query to backfill')
+    parser.add_argument('--shard', choices=['day', 'hour'], default='day', help='size of each shard of the date range')
+    parser.add_argument('--workers', type=int, default=4, help='number of shards scraped at the same time')
+    parser.add_argument('--max', type=int, default=0, help='maximum number of tweets per shard, 0 for no limit')
+    parser.add_argument('--restart', action='store_true', help='scrape shards that were already completed again')
+    parser.add_argument('--rate', type=float, default=float(os.environ.get("SCRAPE_RATE", 1)), help='requests per second to Twitter, shared by all workers')
+    parser.add_argument('--burst', type=float, default=float(os.environ.get("SCRAPE_BURST", 5)), help='requests that may be made at once, shared by all workers')
+    args = parser.parse_args()
+
+    mainDb = connect()
+    query = mainDb.getQuery(ObjectId(args.query))
+    if query is None:
+        print(f'🛑 Query {args.query} not found', file=sys.stderr)
+        sys.exit(1)
+
+    shardSize = datetime.timedelta(days=1) if args.shard == 'day' else datetime.timedelta(hours=1)
+    shards = getShards(query, shardSize)
+
+    # The server never reads new tweets of a query in cold storage
+    if mainDb.isInColdStorage(query):
+        print(f'🛑 Query {args.query} is in cold storage and can\'t be backfilled', file=sys.stderr)
+        sys.exit(1)
+
+    # Skip the shards completed by a previous run, even if it used a different shard size
+    completed = [] if args.restart else mainDb.getBackfillShards(query.id)
+    tasks = [(query, start, end, args.max) for start, end in shards if not isCovered(start, end, completed)]
+    print(f'🔎 Backfilling query {str(query.id)} - {query.name}: {str(len(tasks))}/{str(len(shards))} shards with {str(args.workers)} workers', file=sys.stdout)
+
+    startTime = time.time()
+    total = 0
+    failed = 0
+    with Pool(args.workers, initializer=initWorker, initargs=(args.rate / args.workers, max(1, args.burst / args.workers))) as pool:
+        for i, (start, end, count, seconds, error) in enumerate(pool.imap_unordered(scrapeShardTask, tasks)):
+            total += count
+            if error is not None:
+                failed += 1
+                print(f'🛑 [{str(i + 1)}/{str(len(tasks))}] {start.isoformat()} - {end.isoformat()}: {error}', file=sys.stderr)
+                continue
+
+            # Let the server know to drop the tweets and histograms it cached for the query
+            mainDb.completeBackfillShard(query.id, start, end, count)
+            mainDb.markTweetsChanged(query.id)
+            elapsed = time.time() - startTime
+            print(f'✅ [{str(i + 1)}/{str(len(tasks))}] {start.isoformat()} - {end.isoformat()}: {str(count)} tweets in {seconds:.1f}s ({total / elapsed:.1f} tweets/s overall)', file=sys.stdout)
+
+    print(f'✅ Backfilled {str(total)} tweets for query {str(query.id)} in {time.time() - startTime:.1f}s', file=sys.stdout)
+    if failed > 0:
+        print(f'🛑 {str(failed)} shards weren\'t completed, run the backfill again to retry them', file=sys.stderr)
+    mainDb.client.close()
+
+if __name__ == '__main__':
+    main()
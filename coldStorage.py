@@ -0,0 +1,47 @@
+import datetime
+import gzip
+import json
+import os
+
+from tweet import Tweet
+
+# Stores the tweets of archived queries on local disk as gzipped NDJSON, sorted by relatability score
+class ColdStorage():
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def getTweetsPath(self, queryId):
+        return os.path.join(self.path, f'{str(queryId)}.ndjson.gz')
+
+    def hasQuery(self, queryId):
+        return os.path.exists(self.getTweetsPath(queryId))
+
+    def writeTweets(self, queryId, tweets):
+        tweets = sorted(tweets, key=lambda x: x.relatabilityScore, reverse=True)
+
+        # Write to a temporary file first so readers never see a partial file
+        tweetsPath = self.getTweetsPath(queryId)
+        with gzip.open(tweetsPath + '.tmp', 'wt', encoding='utf-8') as f:
+            for tweet in tweets:
+                f.write(json.dumps(tweet.getJSON()) + '\n')
+
+        os.replace(tweetsPath + '.tmp', tweetsPath)
+
+    # Read the best tweets of a query, only decompressing as many lines as are needed
+    def readTweets(self, max, queryId):
+        tweets = []
+        with gzip.open(self.getTweetsPath(queryId), 'rt', encoding='utf-8') as f:
+            for line in f:
+                if max != 0 and len(tweets) >= max:
+                    break
+                tweetJSON = json.loads(line)
+                tweetJSON['id'] = int(tweetJSON['id'])
+                tweetJSON['date'] = datetime.datetime.fromisoformat(tweetJSON['date'])
+                tweets.append(Tweet.fromDict(tweetJSON))
+        return tweets
+
+    def removeQuery(self, queryId):
+        tweetsPath = self.getTweetsPath(queryId)
+        if os.path.exists(tweetsPath):
+            os.remove(tweetsPath)
@@ -1,14 +1,53 @@
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, OperationFailure
 import pymongo
+import datetime
+import math
+import functools
 import urllib.parse
 import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Mean radius of the earth, used to convert distances to radians
+EARTH_RADIUS_KM = 6378.1
 
 from query import Query
 from tweet import Tweet
 from archivedQuery import ArchivedQuery
+from coldStorage import ColdStorage
+
+# Truncate a date to the start of its time bucket, matching Mongo's $dateTrunc
+def truncateDate(date, unit, binSize):
+    if unit == 'minute':
+        return date.replace(minute=date.minute - date.minute % binSize, second=0, microsecond=0)
+    if unit == 'hour':
+        return date.replace(hour=date.hour - date.hour % binSize, minute=0, second=0, microsecond=0)
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# Decorator recording when a read ran out of the time budget of its thread, even if the caller handles the error
+def timeLimited(fn):
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return fn(self, *args, **kwargs)
+        except ExecutionTimeout:
+            budget = getattr(self.deadline, 'budget', None)
+            if budget is not None:
+                budget['timedOut'] = True
+            raise
+    return wrapper
 
 class Database():
-    def __init__(self, host, username, password):
+    def __init__(self, host, username, password, coldStoragePath=None):
+        # Deadline of the current request, per thread, passed to Mongo as maxTimeMS
+        self.deadline = threading.local()
+
+        # Tweets of old archived queries are moved to local disk when a path is configured
+        self.coldStorage = None
+        if coldStoragePath is not None:
+            self.coldStorage = ColdStorage(coldStoragePath)
+
         print("- Connecting to database...", file=sys.stdout)
         try:
             # Set up the connection URI to the database
@@ -24,19 +63,78 @@ class Database():
             self.queriesCollection = self.db['queries']
             self.tweetsCollection = self.db['tweets']
 
+            # Index used to read the best tweets of a query without an in-memory sort
+            self.tweetsCollection.create_index([('qId', pymongo.ASCENDING), ('rs', pymongo.DESCENDING)])
+
+            # Index used to search the content of tweets
+            self.tweetsCollection.create_index([('content', pymongo.TEXT)])
+
             # Create archived query collection
             self.archivedQueriesCollection = self.db['archive']
 
+            # Media attached to tweets, stored once and referenced by ID from each tweet
+            self.mediaCollection = self.db['media']
+
+            # Completed shards of historical backfills
+            self.backfillCollection = self.db['backfill']
+
+            # Scheduler state of each active query, so jobs can resume after a restart
+            self.jobsCollection = self.db['jobs']
+
+            # One-time data migrations that have already been applied
+            self.migrationsCollection = self.db['migrations']
+
+            # Index used to search tweets by location across queries, once all locations are [lon, lat]
+            self.migrateFallbackLocations()
+            try:
+                self.tweetsCollection.create_index([('loc', pymongo.GEOSPHERE)])
+            except OperationFailure as e:
+                print(f"🛑 Could not create the location index, searching tweets by location is unavailable: {e}", file=sys.stderr)
+
             # Check if the database is connected
             self.client.admin.command('ismaster')
             print("✅ Connected to database", file=sys.stdout)
         except ConnectionFailure:
             print("🛑 Could not connect to database", file=sys.stderr)
             
+    # Tweets without coordinates used to store their query's location as [lat, lon] instead of GeoJSON's [lon, lat]
+    def migrateFallbackLocations(self):
+        if self.migrationsCollection.find_one({'_id': 'fallbackLocations'}) is not None:
+            return
+
+        print("- Swapping the fallback locations of old tweets to [lon, lat]...", file=sys.stdout)
+        swapped = 0
+        for queryJSON in list(self.queriesCollection.find()) + list(self.archivedQueriesCollection.find()):
+            try:
+                latitude, longitude = [float(x) for x in queryJSON['location'].split(',')[:2]]
+            except (KeyError, ValueError):
+                continue
+            if latitude == longitude:
+                continue
+            result = self.tweetsCollection.update_many(
+                {'qId': queryJSON['_id'], 'loc.coordinates': [latitude, longitude]},
+                {'$set': {'loc.coordinates': [longitude, latitude]}}
+            )
+            swapped += result.modified_count
+
+        self.migrationsCollection.insert_one({'_id': 'fallbackLocations', 'swapped': swapped})
+        print(f"✅ Swapped the fallback locations of {str(swapped)} tweets", file=sys.stdout)
+
     def addQuery(self, query):
         _object = self.queriesCollection.insert_one(query.getDict())
         return _object.inserted_id
 
+    # Find an active or archived query by ID
+    def getQuery(self, id):
+        queryJSON = self.queriesCollection.find_one({'_id': id})
+        if queryJSON is None:
+            queryJSON = self.archivedQueriesCollection.find_one({'_id': id})
+        if queryJSON is None:
+            return None
+        query = Query(queryJSON['name'], queryJSON['location'], queryJSON['startDate'], queryJSON['endDate'], queryJSON['keywords'], queryJSON['frequency'], queryJSON['maxTweets'])
+        query.id = queryJSON['_id']
+        return query
+
     def getQueries(self):
         queries = []
         for queryJSON in self.queriesCollection.find():
@@ -45,14 +143,60 @@ class Database():
             queries.append(query)
         return queries
     
+    # Limit the database reads made in this thread to a time budget in milliseconds
+    @contextmanager
+    def timeBudget(self, ms):
+        budget = {'timedOut': False}
+        self.deadline.value = time.monotonic() + ms / 1000
+        self.deadline.budget = budget
+        try:
+            yield budget
+        finally:
+            self.deadline.value = None
+            self.deadline.budget = None
+
+    # Get the milliseconds left in the time budget of this thread, or 0 for no limit
+    def getMaxTimeMS(self):
+        deadline = getattr(self.deadline, 'value', None)
+        if deadline is None:
+            return 0
+        return max(1, int((deadline - time.monotonic()) * 1000))
+
+    # Run a set of writes in a transaction, or directly if the server doesn't support transactions
+    def runTransaction(self, callback):
+        try:
+            with self.client.start_session() as session:
+                session.with_transaction(callback)
+        except OperationFailure as e:
+            # Standalone servers reject transactions with IllegalOperation
+            if e.code != 20:
+                raise
+            callback(None)
+
     def archiveQuery(self, id, query):
-        for queryJSON in self.queriesCollection.find():
-            if queryJSON['_id'] == query.id:
-                archivedQuery = ArchivedQuery(queryJSON['name'], queryJSON['location'], queryJSON['startDate'], queryJSON['endDate'], queryJSON['keywords'], queryJSON['frequency'], queryJSON['maxTweets'], False)
-                archivedQuery.id = queryJSON['_id']
-                self.archivedQueriesCollection.insert_one(archivedQuery.getDict())
-                self.queriesCollection.delete_one({'_id': id})
-                return
+        self.archiveQueries([id])
+
+    def archiveQueries(self, ids):
+        archivedQueries = []
+        for queryJSON in self.queriesCollection.find({'_id': {'$in': ids}}):
+            archivedQuery = ArchivedQuery(queryJSON['name'], queryJSON['location'], queryJSON['startDate'], queryJSON['endDate'], queryJSON['keywords'], queryJSON['frequency'], queryJSON['maxTweets'], False)
+            archivedQuery.id = queryJSON['_id']
+            archivedQueries.append(archivedQuery)
+
+        if len(archivedQueries) == 0:
+            return archivedQueries
+
+        # Move the queries to the archive in one bulk write, then remove them from the active queries
+        operations = [pymongo.ReplaceOne({'_id': archivedQuery.id}, archivedQuery.getDict(), upsert=True) for archivedQuery in archivedQueries]
+        archivedIds = [archivedQuery.id for archivedQuery in archivedQueries]
+
+        def callback(session):
+            self.archivedQueriesCollection.bulk_write(operations, session=session)
+            self.queriesCollection.delete_many({'_id': {'$in': archivedIds}}, session=session)
+            self.jobsCollection.delete_many({'_id': {'$in': archivedIds}}, session=session)
+
+        self.runTransaction(callback)
+        return archivedQueries
 
     def getArchivedQueries(self):
         archivedQueries = []
@@ -73,6 +217,17 @@ class Database():
         
     def removeArchivedQuery(self, id):
         self.archivedQueriesCollection.delete_one({'_id': id})
+        if self.coldStorage is not None:
+            self.coldStorage.removeQuery(id)
+
+    def removeArchivedQueries(self, ids):
+        self.archivedQueriesCollection.delete_many({'_id': {'$in': ids}})
+        if self.coldStorage is not None:
+            for id in ids:
+                self.coldStorage.removeQuery(id)
+
+    def setArchivedQueriesPublic(self, ids, isPublic):
+        self.archivedQueriesCollection.update_many({'_id': {'$in': ids}}, {'$set': {'isPublic': isPublic}})
     
     def updateArchivedQuery(self, id, query):
         self.archivedQueriesCollection.update_one({'_id': id}, {'$set': query.getDict()}, upsert=True)
@@ -82,6 +237,42 @@ class Database():
 
     def removeQuery(self, id):
         self.queriesCollection.delete_one({'_id': id})
+        self.removeJob(id)
+
+    def removeQueries(self, ids):
+        self.queriesCollection.delete_many({'_id': {'$in': ids}})
+        self.jobsCollection.delete_many({'_id': {'$in': ids}})
+
+    # Get the scheduler state of every query, keyed by query ID
+    def getJobs(self):
+        jobs = {}
+        for jobJSON in self.jobsCollection.find():
+            jobs[jobJSON['_id']] = jobJSON
+        return jobs
+
+    def getJob(self, id):
+        return self.jobsCollection.find_one({'_id': id})
+
+    def updateJob(self, id, fields):
+        self.jobsCollection.update_one({'_id': id}, {'$set': fields}, upsert=True)
+
+    # Record that the tweets of a query were written by another process, so the server drops what it cached
+    def markTweetsChanged(self, id):
+        self.jobsCollection.update_one({'_id': id}, {'$set': {'tweetsChanged': datetime.datetime.now(datetime.timezone.utc)}}, upsert=True)
+
+    # Get when the tweets of each query were last written by another process, keyed by query ID
+    def getTweetsChanged(self):
+        changed = {}
+        for jobJSON in self.jobsCollection.find({'tweetsChanged': {'$exists': True}}, {'tweetsChanged': 1}):
+            changed[jobJSON['_id']] = jobJSON['tweetsChanged']
+        return changed
+
+    # Mark the current scrape of a query as complete
+    def clearJobProgress(self, id):
+        self.jobsCollection.update_one({'_id': id}, {'$unset': {'progress': ''}})
+
+    def removeJob(self, id):
+        self.jobsCollection.delete_one({'_id': id})
 
     def addTweets(self, tweets):
         # Use bulk operations to insert all tweets in one go while maintaining old tweets
@@ -91,22 +282,218 @@ class Database():
             operations.append(pymongo.UpdateOne({'id': tweet.id}, {'$set': tweet.getDict()}, upsert=True))
         self.tweetsCollection.bulk_write(operations)
 
+    def addMedia(self, media):
+        if len(media) == 0:
+            return
+        operations = []
+        for mediaInfo in media:
+            operations.append(pymongo.UpdateOne({'_id': mediaInfo['_id']}, {'$set': {k: v for k, v in mediaInfo.items() if k != '_id'}}, upsert=True))
+        self.mediaCollection.bulk_write(operations)
+
+    # Replace the media IDs of tweets in their JSON with the media, as it was embedded before media was normalized
+    # Tweets saved before then already embed their media, and IDs of media that can't be found are dropped
+    @timeLimited
+    def resolveMedia(self, tweetJSONs):
+        mediaIds = list({m for tweetJSON in tweetJSONs for m in tweetJSON['media'] if isinstance(m, str)})
+        if len(mediaIds) == 0:
+            return tweetJSONs
+
+        media = {}
+        for mediaJSON in self.mediaCollection.find({'_id': {'$in': mediaIds}}).max_time_ms(self.getMaxTimeMS()):
+            media[mediaJSON['_id']] = {k: v for k, v in mediaJSON.items() if k in ('type', 'url', 'contentType')}
+
+        # Build new lists, as the JSON shares its media list with the tweet, which may be cached
+        for tweetJSON in tweetJSONs:
+            tweetJSON['media'] = [media[m] if isinstance(m, str) else m for m in tweetJSON['media'] if not isinstance(m, str) or m in media]
+        return tweetJSONs
+
+    # Get the unique media of a query, ranked by the best score of any tweet carrying it
+    @timeLimited
+    def getBestMediaFromQuery(self, max, query):
+        if self.isInColdStorage(query):
+            ranking = {}
+            for tweet in self.coldStorage.readTweets(0, query.id):
+                # Tweets saved before media was normalized hold the media itself rather than its ID
+                for mediaId in [m for m in tweet.media if isinstance(m, str)]:
+                    entry = ranking.setdefault(mediaId, {'_id': mediaId, 'rs': tweet.relatabilityScore, 'tweets': 0})
+                    if tweet.relatabilityScore > entry['rs']:
+                        entry['rs'] = tweet.relatabilityScore
+                    entry['tweets'] += 1
+            ranking = sorted(ranking.values(), key=lambda x: x['rs'], reverse=True)
+            if max != 0:
+                ranking = ranking[:max]
+
+            mediaInfo = {}
+            for mediaJSON in self.mediaCollection.find({'_id': {'$in': [entry['_id'] for entry in ranking]}}):
+                mediaInfo[mediaJSON['_id']] = mediaJSON
+            for entry in ranking:
+                entry['info'] = mediaInfo.get(entry['_id'])
+        else:
+            pipeline = [
+                {'$match': {'qId': query.id}},
+                {'$unwind': '$media'},
+                {'$match': {'media': {'$type': 'string'}}},
+                {'$group': {'_id': '$media', 'rs': {'$max': '$rs'}, 'tweets': {'$sum': 1}}},
+                {'$sort': {'rs': pymongo.DESCENDING}}
+            ]
+            if max != 0:
+                pipeline.append({'$limit': max})
+            pipeline += [
+                {'$lookup': {'from': 'media', 'localField': '_id', 'foreignField': '_id', 'as': 'info'}},
+                {'$set': {'info': {'$first': '$info'}}}
+            ]
+            ranking = list(self.tweetsCollection.aggregate(pipeline, maxTimeMS=self.getMaxTimeMS()))
+
+        media = []
+        for entry in ranking:
+            if entry.get('info') is not None:
+                mediaJSON = dict(entry['info'])
+                mediaJSON['id'] = mediaJSON.pop('_id')
+                mediaJSON['rs'] = entry['rs']
+                mediaJSON['tweets'] = entry['tweets']
+                media.append(mediaJSON)
+        return media
+
+    @timeLimited
     def getBestTweetsFromQuery(self, max, query):
         tweets = []
-        for tweetJSON in self.tweetsCollection.find({'qId': query.id}).sort('rs', pymongo.DESCENDING).limit(max):
+        for tweetJSON in self.tweetsCollection.find({'qId': query.id}).sort('rs', pymongo.DESCENDING).limit(max).max_time_ms(self.getMaxTimeMS()):
             tweetJSON['qId'] = str(tweetJSON['qId'])
             tweets.append(Tweet.fromDict(tweetJSON))
         return tweets
     
+    @timeLimited
     def getBestTweetsFromArchivedQuery(self, max, archivedQuery):
+        if self.isInColdStorage(archivedQuery):
+            return self.coldStorage.readTweets(max, archivedQuery.id)
+
         tweets = []
         if max == 0:
-            for tweetJSON in self.tweetsCollection.find({'qId': archivedQuery.id}).sort('rs', pymongo.DESCENDING):
+            for tweetJSON in self.tweetsCollection.find({'qId': archivedQuery.id}).sort('rs', pymongo.DESCENDING).max_time_ms(self.getMaxTimeMS()):
                 tweetJSON['qId'] = str(tweetJSON['qId'])
                 tweets.append(Tweet.fromDict(tweetJSON))
             return tweets
         else:
-            for tweetJSON in self.tweetsCollection.find({'qId': archivedQuery.id}).sort('rs', pymongo.DESCENDING).limit(max):
+            for tweetJSON in self.tweetsCollection.find({'qId': archivedQuery.id}).sort('rs', pymongo.DESCENDING).limit(max).max_time_ms(self.getMaxTimeMS()):
                 tweetJSON['qId'] = str(tweetJSON['qId'])
                 tweets.append(Tweet.fromDict(tweetJSON))
-            return tweets
\ No newline at end of file
+            return tweets
+
+    def isInColdStorage(self, archivedQuery):
+        return self.coldStorage is not None and self.coldStorage.hasQuery(archivedQuery.id)
+
+    # Move the tweets of an archived query out of the tweets collection into cold storage
+    def moveToColdStorage(self, archivedQuery):
+        if self.coldStorage is None or self.isInColdStorage(archivedQuery):
+            return 0
+
+        tweets = self.getBestTweetsFromArchivedQuery(0, archivedQuery)
+        self.coldStorage.writeTweets(archivedQuery.id, tweets)
+
+        # Only drop the tweets from the database if none were added while they were being written
+        if len(tweets) != self.tweetsCollection.count_documents({'qId': archivedQuery.id}):
+            self.coldStorage.removeQuery(archivedQuery.id)
+            raise IOError(f'Tweets of query {str(archivedQuery.id)} changed while moving to cold storage')
+        self.tweetsCollection.delete_many({'qId': archivedQuery.id})
+        return len(tweets)
+
+    # Count tweets, engagement and the best score of a query per time bucket
+    @timeLimited
+    def getTweetHistogram(self, query, unit, binSize):
+        if self.isInColdStorage(query):
+            buckets = {}
+            for tweet in self.coldStorage.readTweets(0, query.id):
+                start = truncateDate(tweet.date, unit, binSize)
+                bucket = buckets.setdefault(start, {'start': start, 'count': 0, 'engagement': 0, 'maxRs': tweet.relatabilityScore})
+                bucket['count'] += 1
+                bucket['engagement'] += tweet.likes + tweet.retweets + tweet.replies
+                bucket['maxRs'] = max(bucket['maxRs'], tweet.relatabilityScore)
+            return [buckets[start] for start in sorted(buckets)]
+
+        histogram = []
+        pipeline = [
+            {'$match': {'qId': query.id}},
+            {'$group': {
+                '_id': {'$dateTrunc': {'date': '$date', 'unit': unit, 'binSize': binSize}},
+                'count': {'$sum': 1},
+                'engagement': {'$sum': {'$add': ['$likes', '$rt', '$rp']}},
+                'maxRs': {'$max': '$rs'}
+            }},
+            {'$sort': {'_id': pymongo.ASCENDING}}
+        ]
+        for bucketJSON in self.tweetsCollection.aggregate(pipeline, maxTimeMS=self.getMaxTimeMS()):
+            histogram.append({
+                'start': bucketJSON['_id'],
+                'count': bucketJSON['count'],
+                'engagement': bucketJSON['engagement'],
+                'maxRs': bucketJSON['maxRs']
+            })
+        return histogram
+
+    @timeLimited
+    def getBestTweetsFromLocation(self, max, location, match=None):
+        tweets = []
+        for tweetJSON in self.tweetsCollection.find({'loc': {'$geoWithin': location}, **(match or {})}).sort('rs', pymongo.DESCENDING).limit(max).max_time_ms(self.getMaxTimeMS()):
+            tweetJSON['qId'] = str(tweetJSON['qId'])
+            tweets.append(Tweet.fromDict(tweetJSON))
+        return tweets
+
+    # Get the best tweets within a radius in kilometres of a point
+    def getBestTweetsNear(self, max, longitude, latitude, radius):
+        return self.getBestTweetsFromLocation(max, {'$centerSphere': [[longitude, latitude], radius / EARTH_RADIUS_KM]})
+
+    # Get the best tweets within a bounding box
+    # Polygon edges are geodesics, which bow toward the pole, so the top and bottom edges get a vertex every half degree of
+    # longitude to follow their latitude closely, and the coordinates are filtered so nothing outside the box is returned
+    def getBestTweetsWithin(self, max, minLongitude, minLatitude, maxLongitude, maxLatitude):
+        steps = int(math.ceil((maxLongitude - minLongitude) / 0.5))
+        longitudes = [minLongitude + (maxLongitude - minLongitude) * i / steps for i in range(steps + 1)] if steps > 0 else [minLongitude, maxLongitude]
+        ring = [[longitude, minLatitude] for longitude in longitudes] + [[longitude, maxLatitude] for longitude in reversed(longitudes)]
+        ring.append(ring[0])
+
+        return self.getBestTweetsFromLocation(max, {'$geometry': {
+            'type': 'Polygon',
+            'coordinates': [ring]
+        }}, {
+            'loc.coordinates.0': {'$gte': minLongitude, '$lte': maxLongitude},
+            'loc.coordinates.1': {'$gte': minLatitude, '$lte': maxLatitude}
+        })
+
+    # Get the (start, end) ranges of the backfill shards of a query that are already complete
+    def getBackfillShards(self, id):
+        return [(shardJSON['start'], shardJSON['end']) for shardJSON in self.backfillCollection.find({'qId': id})]
+
+    def completeBackfillShard(self, id, start, end, count):
+        self.backfillCollection.update_one({'qId': id, 'start': start, 'end': end}, {'$set': {'count': count}}, upsert=True)
+
+    # Search the content of tweets, ranked by text relevance weighted by relatability score
+    @timeLimited
+    def searchTweets(self, text, queryIds=None, startDate=None, endDate=None, minScore=None, skip=0, max=50):
+        match = {'$text': {'$search': text}}
+        if queryIds is not None:
+            match['qId'] = {'$in': queryIds}
+        if startDate is not None or endDate is not None:
+            match['date'] = {}
+            if startDate is not None:
+                match['date']['$gte'] = startDate
+            if endDate is not None:
+                match['date']['$lte'] = endDate
+        if minScore is not None:
+            match['rs'] = {'$gte': minScore}
+
+        pipeline = [
+            {'$match': match},
+            {'$addFields': {'score': {'$multiply': [
+                {'$meta': 'textScore'},
+                {'$add': [1, {'$ln': {'$add': [1, '$rs']}}]}
+            ]}}},
+            {'$sort': {'score': pymongo.DESCENDING}},
+            {'$skip': skip},
+            {'$limit': max}
+        ]
+
+        tweets = []
+        for tweetJSON in self.tweetsCollection.aggregate(pipeline, maxTimeMS=self.getMaxTimeMS()):
+            tweetJSON['qId'] = str(tweetJSON['qId'])
+            tweets.append(Tweet.fromDict(tweetJSON))
+        return tweets
@@ -0,0 +1,129 @@
+import collections
+import gzip
+import threading
+
+from flask import Flask, Response, current_app, request
+
+# Brotli and MessagePack are optional, responses fall back to gzip and JSON without them
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Responses smaller than this are not worth compressing
+compressMinSize = 1024
+
+# Convert a GeoJSON feature collection to parallel arrays, which map layers can load directly
+def getColumnarGeoJSON(geojson):
+    columns = {
+        'ids': [],
+        'queries': [],
+        'coordinates': [],
+        'scores': []
+    }
+    for feature in geojson['features']:
+        columns['ids'].append(feature['properties']['id'])
+        columns['queries'].append(feature['properties'].get('query'))
+        columns['coordinates'].append(feature['geometry']['coordinates'])
+        columns['scores'].append(feature['properties']['score'])
+    return columns
+
+# Get the format requested with ?format= or the Accept header
+def getRequestedFormat(request):
+    format = request.args.get('format')
+    if format is not None:
+        return format
+    if msgpack is not None and request.accept_mimetypes.best_match(['application/json', 'application/msgpack']) == 'application/msgpack':
+        return 'msgpack'
+    return 'json'
+
+def compress(request, response):
+    if response.content_length is None or response.content_length < compressMinSize:
+        return response
+
+    if brotli is not None and request.accept_encodings['br']:
+        # The default quality of 11 is meant for static files and far too slow per request
+        mode = brotli.MODE_TEXT if response.mimetype == 'application/json' else brotli.MODE_GENERIC
+        response.set_data(brotli.compress(response.get_data(), quality=4, mode=mode))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# Encode the dict returned by a route in the format requested, before it is turned into JSON
+def encodeBody(request, rv):
+    body, rest = (rv[0], rv[1:]) if isinstance(rv, tuple) else (rv, ())
+    if not isinstance(body, dict):
+        return rv
+
+    format = getRequestedFormat(request)
+    if format == 'columnar' and 'geojson' in body:
+        # Copy rather than change the dict, which may be shared between coalesced requests
+        body = dict(body, geojson=getColumnarGeoJSON(body['geojson']))
+    elif format == 'msgpack' and msgpack is not None:
+        body = Response(msgpack.packb(body), mimetype='application/msgpack')
+    return (body,) + rest if len(rest) > 0 else body
+
+# Flask app whose route dicts are encoded in the format the client asked for
+class EncodedFlask(Flask):
+    def make_response(self, rv):
+        return super().make_response(encodeBody(request, rv))
+
+# Compress a response if the client accepts it
+def encodeResponse(request, response):
+    if response.is_streamed or response.direct_passthrough or response.mimetype not in ('application/json', 'application/msgpack') or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if msgpack is not None:
+        response.vary.add('Accept')
+    return compress(request, response)
+
+# Keeps the encoded and compressed bytes of shared route dicts, so coalesced requests don't encode the same result again
+class EncodedResponses():
+    def __init__(self, maxEntries=32):
+        self.lock = threading.Lock()
+        self.maxEntries = maxEntries
+
+        # Maps a key, format and content encoding to the dict it was built from and its encoded response
+        self.entries = collections.OrderedDict()
+
+    def getContentEncoding(self, request):
+        if brotli is not None and request.accept_encodings['br']:
+            return 'br'
+        if request.accept_encodings['gzip']:
+            return 'gzip'
+        return None
+
+    # Get the response for a route dict, only encoding it again once the dict is replaced by a new result
+    def get(self, request, key, body):
+        entryKey = (key, getRequestedFormat(request), self.getContentEncoding(request))
+        with self.lock:
+            entry = self.entries.get(entryKey)
+            if entry is not None and entry[0] is body:
+                self.entries.move_to_end(entryKey)
+            else:
+                entry = None
+
+        if entry is None:
+            response = encodeResponse(request, current_app.make_response(body))
+            entry = (body, response.get_data(), response.mimetype, response.headers.get('Content-Encoding'), list(response.vary))
+            with self.lock:
+                self.entries[entryKey] = entry
+                self.entries.move_to_end(entryKey)
+                while len(self.entries) > self.maxEntries:
+                    self.entries.popitem(last=False)
+
+        _, data, mimetype, contentEncoding, vary = entry
+        response = Response(data, mimetype=mimetype)
+        if contentEncoding is not None:
+            response.headers['Content-Encoding'] = contentEncoding
+        for header in vary:
+            response.vary.add(header)
+        return response
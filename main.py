@@ -2,16 +2,24 @@
 from database import Database
 from query import Query
 from archivedQuery import ArchivedQuery
+from tweetCache import TweetCache
+from tweetHub import TweetHub
+from singleFlight import SingleFlight
+import encoding
+from admission import AdmissionControl
+from rateLimiter import RateLimiter
+from scraper import LimitedSearchScraper
+from profiling import Profiler
 import algorithm as algo
 import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
 from bson.objectid import ObjectId
-import snscrape.modules.twitter as sntwitter
 import os
 import sys
 import atexit
 
-from flask import Flask, request
+from flask import Response, request
 from flask_cors import CORS
 
 # Load environment variables
@@ -21,11 +29,21 @@ load_dotenv()
 # Timeout the queries?
 timeoutQueries = False
 
+# Number of tweets scored and saved at a time while scraping
+scrapeBatchSize = 100
+
+# Seconds between overdue queries when resuming them on startup
+startupStagger = 30
+
 # Requires timezone, and for NTP this is in Toronto
-sched = BackgroundScheduler(daemon=True, timezone='America/Toronto')
+# The number of jobs running at once is bounded so scraping can't take every database connection
+sched = BackgroundScheduler(daemon=True, timezone='America/Toronto', executors={'default': ThreadPoolExecutor(int(os.environ.get("SCHEDULER_THREADS", 4)))})
 
 # Start the database connection
-db = Database(str(os.environ.get("MONGODB_HOST")), str(os.environ.get("MONGODB_USER")), str(os.environ.get("MONGODB_PASS")))
+db = Database(str(os.environ.get("MONGODB_HOST")), str(os.environ.get("MONGODB_USER")), str(os.environ.get("MONGODB_PASS")), os.environ.get("COLD_STORAGE_DIR"))
+
+# Number of days after their end date that archived queries are moved to cold storage
+coldStorageAfterDays = float(os.environ.get("COLD_STORAGE_AFTER_DAYS", 0))
 
 # Populate local queries
 queries = db.getQueries()
@@ -33,7 +51,61 @@ queries = db.getQueries()
 # Populate archived queries
 archivedQueries = db.getArchivedQueries()
 
+# Profiling is only enabled when a token for the admin routes is set
+profiler = Profiler(os.environ.get("PROFILING_TOKEN"))
+
+# Limit the requests made to Twitter by all scrape jobs together, in requests per second
+scrapeLimiter = RateLimiter(float(os.environ.get("SCRAPE_RATE", 1)), float(os.environ.get("SCRAPE_BURST", 5)))
+
+# Keep the top tweets and histograms of the most recently read queries in memory so reads don't scan the whole collection
+tweetCache = TweetCache(int(os.environ.get("TWEET_CACHE_QUERIES", 50)))
+
+# Push newly scored tweets to clients streaming the queries
+# Streams hold a server thread each, but an idle one only wakes for keep-alives, so SERVER_THREADS is sized to hold LIVE_MAX_STREAMS on top of the limited routes
+tweetHub = TweetHub(int(os.environ.get("LIVE_MAX_STREAMS", 32)), int(os.environ.get("LIVE_MAX_LIFETIME", 300)), resolve=db.resolveMedia)
+
+# Requests to expensive routes are limited per class and given a database time budget, cheap routes always get through
+# Running and queued requests of every class, public route waiters and live streams together stay below SERVER_THREADS,
+# so threads are left free for health checks even when every queue is full
+serverThreads = int(os.environ.get("SERVER_THREADS", 48))
+admission = AdmissionControl(db.timeBudget)
+admission.addClass('read', limit=3, queue=2, wait=5, budget=5000)
+admission.addClass('aggregate', limit=2, queue=1, wait=2, budget=10000)
+
+# Coalesce identical requests for the public aggregate routes, keeping the result for a few seconds
+# Only the request computing a result is admitted, a bounded number of others wait for it without taking a slot
+publicResponses = SingleFlight(ttl=5, keep=lambda response: isinstance(response, dict) and response.get('status') == 200, timeout=10, maxWaiters=4)
+encodedPublicResponses = encoding.EncodedResponses()
+
+reservedThreads = admission.getReservedThreads() + publicResponses.maxWaiters + tweetHub.maxStreams
+if reservedThreads >= serverThreads:
+    print(f'🛑 Limited routes and live streams can hold {str(reservedThreads)} of {str(serverThreads)} server threads, raise SERVER_THREADS so cheap routes always get through', file=sys.stderr)
+
+# Time buckets supported by the histogram routes, as a $dateTrunc unit and bin size
+histogramBuckets = {
+    '5min': ('minute', 5),
+    'hour': ('hour', 1),
+    'day': ('day', 1)
+}
+
+# Get the best tweets of a query from the cache, falling back to the database
+def getBestTweets(max, query):
+    return tweetCache.get(max, query, db.getBestTweetsFromQuery)
+
+def getBestArchivedTweets(max, query):
+    return tweetCache.get(max, query, db.getBestTweetsFromArchivedQuery)
+
+# Score a batch of fetched tweets, save them and record how far the scrape has got
+def saveTweets(query, tweetList, count):
+    tweets = algo.solveAlgo(query, tweetList)
+    db.addMedia(algo.extractMedia(tweetList))
+    db.addTweets(tweets)
+    tweetCache.update(query, tweets)
+    tweetHub.publish(query.id, tweets)
+    db.updateJob(query.id, {'progress': {'count': count, 'lastId': tweetList[-1]['id']}})
+
 # Fetch the queries then send the results to the algorithm
+@profiler.track
 def fetchTweetsLite(query):
 
     # If timeout is enabled, check if the query has timed out
@@ -45,52 +117,129 @@ def fetchTweetsLite(query):
 
     print(f'🔎 Fetching tweets for query {query.id}', file=sys.stdout)
 
-    tweetList = []
+    # Record the run so the schedule can be resumed after a restart
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db.updateJob(query.id, {'lastRun': now, 'nextRun': now + datetime.timedelta(minutes=query.frequency)})
 
-    # Format keywords for the query
-    keywordQuery = ''
-    for keyword in query.keywords[:-1]:
-        keywordQuery += keyword + ' OR '
-    keywordQuery += query.keywords[-1]
+    tweetList = []
 
-    # Fetch tweets then loop through them until the max number of tweets is reached
-    for i,tweet in enumerate(sntwitter.TwitterSearchScraper(f'{keywordQuery} since:{query.startDate.strftime("%Y-%m-%d")} until:{query.endDate.strftime("%Y-%m-%d")} filter:media filter:has_engagement geocode:"{query.location}"').get_items()):
-        if i >= query.maxTweets:
-            break
-        tweetList.append({
-                'id': tweet.id,
-                'content': tweet.content,
-                'media': tweet.media,
-                'likes': tweet.likeCount,
-                'retweets': tweet.retweetCount,
-                'replies': tweet.replyCount,
-                'date': tweet.date,
-                'coordinates': tweet.coordinates,
-            })
+    searchQuery = f'{query.getKeywordQuery()} since:{query.startDate.strftime("%Y-%m-%d")} until:{query.endDate.strftime("%Y-%m-%d")} filter:media filter:has_engagement geocode:"{query.location}"'
 
-    # Solve the resulting tweets with the algorithm
-    print(f'✅ {str(tweetList.__len__())}/{str(query.maxTweets)} tweets fetched for {query.id} - {query.name}', file=sys.stdout)
-    db.addTweets(algo.solveAlgo(query, tweetList))
+    # Resume an interrupted scrape after the last tweet that was saved, as results are newest first
+    count = 0
+    job = db.getJob(query.id)
+    if job is not None and 'progress' in job:
+        count = job['progress']['count']
+        searchQuery += f' max_id:{str(job["progress"]["lastId"] - 1)}'
+        print(f'- Resuming fetching of tweets for query {query.id} after {str(count)} tweets', file=sys.stdout)
 
-# Schedule the queries
-def scheduleQuery(query):
-    sched.add_job(fetchTweetsLite, 'interval', minutes=query.frequency, args=[query], id=str(query.id))
+    # Fetch tweets then loop through them until the max number of tweets is reached, saving them in batches
+    for tweet in LimitedSearchScraper(searchQuery, scrapeLimiter, query.id).get_items():
+        if count >= query.maxTweets:
+            break
+        tweetList.append(algo.getTweetInfo(tweet))
+        count += 1
+
+        if len(tweetList) >= scrapeBatchSize:
+            saveTweets(query, tweetList, count)
+            tweetList = []
+
+    # Solve the remaining tweets with the algorithm
+    if len(tweetList) > 0:
+        saveTweets(query, tweetList, count)
+    db.clearJobProgress(query.id)
+    print(f'✅ {str(count)}/{str(query.maxTweets)} tweets fetched for {query.id} - {query.name}', file=sys.stdout)
+
+# Schedule the queries, optionally resuming at a previously planned run time
+def scheduleQuery(query, nextRun=None):
+    if nextRun is None:
+        sched.add_job(fetchTweetsLite, 'interval', minutes=query.frequency, args=[query], id=str(query.id))
+    else:
+        sched.add_job(fetchTweetsLite, 'interval', minutes=query.frequency, args=[query], id=str(query.id), next_run_time=nextRun)
     print(f'✅ Scheduled fetching of tweets every {str(query.frequency)} minutes for query {str(query.id)} - {query.name}', file=sys.stdout)
 
+# Find when each query should next run after a restart, spreading out the overdue and interrupted ones
+def getResumeTimes(queryList):
+    jobs = db.getJobs()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    overdue = 0
+    resumeTimes = {}
+    for query in queryList:
+        job = jobs.get(query.id)
+        if job is None or 'nextRun' not in job:
+            continue
+
+        nextRun = job['nextRun'].replace(tzinfo=datetime.timezone.utc)
+        if 'progress' in job or nextRun <= now:
+            nextRun = now + datetime.timedelta(seconds=startupStagger * overdue)
+            overdue += 1
+        resumeTimes[query.id] = nextRun
+    return resumeTimes
+
 # Unschedule the queries
 def unscheduleQuery(query):
     sched.remove_job(str(query.id))
     print(f'🛑 Unscheduled fetching of tweets for query {str(query.id)} - {query.name}', file=sys.stdout)
 
-# On startup, schedule the queries
+# Unschedule several queries at once
+def unscheduleQueries(queryList):
+    for query in queryList:
+        sched.remove_job(str(query.id))
+    print(f'🛑 Unscheduled fetching of tweets for {str(len(queryList))} queries', file=sys.stdout)
+
+# Parse a comma separated list of query IDs from the request arguments
+def getRequestIds():
+    return [ObjectId(id) for id in request.args.to_dict()['ids'].split(',') if id != '']
+
+# Move the tweets of archived queries that are old enough to cold storage
+def tierArchivedQueries():
+    cutoff = datetime.datetime.today() - datetime.timedelta(days=coldStorageAfterDays)
+    for archivedQuery in list(archivedQueries):
+        if archivedQuery.endDate <= cutoff and not db.isInColdStorage(archivedQuery):
+            try:
+                count = db.moveToColdStorage(archivedQuery)
+                print(f'🧊 Moved {str(count)} tweets of archived query {str(archivedQuery.id)} - {archivedQuery.name} to cold storage', file=sys.stdout)
+            except Exception as e:
+                print(f'🛑 Could not move archived query {str(archivedQuery.id)} to cold storage: {e}', file=sys.stderr)
+
+# Run the tiering in the background, e.g. right after queries are archived
+def scheduleTiering():
+    if db.coldStorage is not None:
+        sched.add_job(tierArchivedQueries, id='tierArchivedQueries', replace_existing=True)
+
+# When the tweets of each query were last written by another process, such as a backfill
+tweetsChanged = db.getTweetsChanged()
+
+# Drop what was cached for queries whose tweets were written by another process
+def checkTweetsChanged():
+    for id, changed in db.getTweetsChanged().items():
+        if tweetsChanged.get(id) != changed:
+            tweetsChanged[id] = changed
+            tweetCache.invalidate(id)
+            publicResponses.forget()
+
+# On startup, schedule the queries where they left off
+resumeTimes = getResumeTimes(queries)
 for query in queries:
-    scheduleQuery(query)
+    scheduleQuery(query, resumeTimes.get(query.id))
+
+sched.add_job(checkTweetsChanged, 'interval', minutes=1, id='checkTweetsChanged')
+
+# Check for archived queries to move to cold storage on startup and once a day
+if db.coldStorage is not None:
+    scheduleTiering()
+    sched.add_job(tierArchivedQueries, 'interval', hours=24, id='tierArchivedQueriesDaily')
 
 sched.start()
 
-app = Flask(__name__)
+app = encoding.EncodedFlask(__name__)
 CORS(app)
 
+# Compress large responses, which were encoded in the format the client asked for by the app
+@app.after_request
+def encodeResponse(response):
+    return encoding.encodeResponse(request, response)
+
 # Route to create a new query
 @app.route('/', methods=['GET'])
 def homeRoute():
@@ -140,6 +289,7 @@ def removeQuery(id):
             db.removeQuery(ObjectId(id))
             unscheduleQuery(query)
             queries.remove(query)
+            tweetCache.remove(query)
             return {
                 'status': 200,
                 'message': 'Query successfully removed'
@@ -164,6 +314,7 @@ def archiveQuery(id):
             unscheduleQuery(query)
             queries.remove(query)
             print(f'📂 Successful archiving of query {str(query.id)} - {query.name}', file=sys.stdout)
+            scheduleTiering()
             return {
                 'status': 200,
                 'message': 'Query successfully archived'
@@ -181,6 +332,8 @@ def removeArchivedQuery(id):
             print('- Found query ' + id, file=sys.stdout)
             db.removeArchivedQuery(ObjectId(id))
             archivedQueries.remove(query)
+            tweetCache.remove(query)
+            publicResponses.forget()
             print('-Removed archived query ' + id, file=sys.stdout)
             return {
                 'status': 200,
@@ -214,9 +367,11 @@ def updateQuery(id):
                     newQuery.id = ObjectId(id)
 
                     db.updateQuery(ObjectId(id), newQuery)
+                    db.removeJob(ObjectId(id))
 
                     unscheduleQuery(query)
                     queries.remove(query)
+                    tweetCache.remove(query)
 
                     scheduleQuery(newQuery)
                     queries.append(newQuery)
@@ -253,6 +408,7 @@ def changeQueryPublic(id):
                 newArchivedQuery = query
                 newArchivedQuery.isPublic = eval(args['isPublic'].capitalize())
                 db.updateArchivedQuery(ObjectId(id), newArchivedQuery)
+                publicResponses.forget()
                 return {
                     'status': 200,
                     'message': 'Query successfully updated'
@@ -270,6 +426,116 @@ def changeQueryPublic(id):
 
 
 
+# Route to archive a list of queries, simultaneously removing them from the active queries
+@app.route('/queries/archive', methods=['POST'])
+def archiveQueries():
+    try:
+        ids = getRequestIds()
+    except:
+        return {
+            'status': 500,
+            'message': 'Error archiving queries, check the arguments'
+        }
+
+    print(f'- Archiving {str(len(ids))} queries...', file=sys.stdout)
+    archived = db.archiveQueries(ids)
+    archivedIds = [aQuery.id for aQuery in archived]
+
+    activeQueries = [query for query in queries if query.id in archivedIds]
+    unscheduleQueries(activeQueries)
+    for query in activeQueries:
+        queries.remove(query)
+    archivedQueries.extend(archived)
+
+    print(f'📂 Successful archiving of {str(len(archived))} queries', file=sys.stdout)
+    scheduleTiering()
+    return {
+        'status': 200,
+        'message': 'Queries successfully archived',
+        'archived': [str(id) for id in archivedIds],
+        'notFound': [str(id) for id in ids if id not in archivedIds]
+    }
+
+# Route to delete a list of queries
+@app.route('/queries/remove', methods=['POST'])
+def removeQueries():
+    try:
+        ids = getRequestIds()
+    except:
+        return {
+            'status': 500,
+            'message': 'Error removing queries, check the arguments'
+        }
+
+    print(f'- Removing {str(len(ids))} queries...', file=sys.stdout)
+    removed = [query for query in queries if query.id in ids]
+    removedIds = [query.id for query in removed]
+    db.removeQueries(removedIds)
+    unscheduleQueries(removed)
+    for query in removed:
+        queries.remove(query)
+        tweetCache.remove(query)
+
+    return {
+        'status': 200,
+        'message': 'Queries successfully removed',
+        'removed': [str(id) for id in removedIds],
+        'notFound': [str(id) for id in ids if id not in removedIds]
+    }
+
+# Route to delete a list of archived queries
+@app.route('/queries/archive/remove', methods=['POST'])
+def removeArchivedQueries():
+    try:
+        ids = getRequestIds()
+    except:
+        return {
+            'status': 500,
+            'message': 'Error removing queries, check the arguments'
+        }
+
+    print(f'- Removing {str(len(ids))} archived queries...', file=sys.stdout)
+    removed = [query for query in archivedQueries if query.id in ids]
+    removedIds = [query.id for query in removed]
+    db.removeArchivedQueries(removedIds)
+    for query in removed:
+        archivedQueries.remove(query)
+        tweetCache.remove(query)
+    publicResponses.forget()
+
+    return {
+        'status': 200,
+        'message': 'Queries successfully removed',
+        'removed': [str(id) for id in removedIds],
+        'notFound': [str(id) for id in ids if id not in removedIds]
+    }
+
+# Route to make a list of archived queries public or private
+@app.route('/queries/archive/public', methods=['POST'])
+def changeQueriesPublic():
+    try:
+        ids = getRequestIds()
+        isPublic = request.args.to_dict()['isPublic'].lower() == 'true'
+    except:
+        return {
+            'status': 500,
+            'message': 'Error updating queries, check the arguments'
+        }
+
+    updated = [query for query in archivedQueries if query.id in ids]
+    updatedIds = [query.id for query in updated]
+    db.setArchivedQueriesPublic(updatedIds, isPublic)
+    for query in updated:
+        query.isPublic = isPublic
+    publicResponses.forget()
+
+    return {
+        'status': 200,
+        'message': 'Queries successfully updated',
+        'updated': [str(id) for id in updatedIds],
+        'notFound': [str(id) for id in ids if id not in updatedIds]
+    }
+
 @app.route('/query/<string:id>', methods=['GET'])
 def getQuery(id):
     # Sometimes in the application, we will recieve an undefined ID, this is to prevent that
@@ -311,13 +577,39 @@ def getArchivedQuery(id):
         'message': 'Query not found'
     }
 
+# Respond with a live stream, or ask the client to retry later if too many are open
+def getLiveResponse(stream):
+    if stream is None:
+        return {
+            'status': 503,
+            'message': 'Too many live streams are open, try again later'
+        }, 503, {'Retry-After': str(tweetHub.retry)}
+    return Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+# Stream the tweets of a query as Server-Sent Events as soon as they are scored
+@app.route('/query/<string:id>/live', methods=['GET'])
+def getLiveTweetsFromQuery(id):
+    for query in queries:
+        if query.id == ObjectId(id):
+            return getLiveResponse(tweetHub.stream(query.id))
+    return {
+        'status': 500,
+        'message': 'Query not found'
+    }
+
+# Stream the tweets of all active queries as Server-Sent Events
+@app.route('/queries/active/live', methods=['GET'])
+def getLiveTweetsFromAllActiveQueries():
+    return getLiveResponse(tweetHub.stream())
+
 @app.route('/query/<string:id>/tweets', methods=['GET'])
+@admission.limit('read')
 def getTweetsFromQuery(id):
     for query in queries:
         if query.id == ObjectId(id):
             try:
                 response = []
-                tweets = db.getBestTweetsFromQuery(int(request.args.to_dict()['limit']), query)
+                tweets = getBestTweets(int(request.args.to_dict()['limit']), query)
 
                 for tweet in tweets:
                     response.append(tweet.getJSON())
@@ -325,7 +617,7 @@ def getTweetsFromQuery(id):
                 return {
                     'status': 200,
                     'message': 'Successfully retrieved tweets',
-                    'tweets': response
+                    'tweets': db.resolveMedia(response)
                 }
             except:
                 return {
@@ -338,12 +630,13 @@ def getTweetsFromQuery(id):
     }
 
 @app.route('/query/archive/<string:id>/tweets', methods = ['GET'])
+@admission.limit('read')
 def getTweetsFromArchivedQuery(id):
     for query in archivedQueries:
         if query.id == ObjectId(id):
             try:
                 response = []
-                tweets = db.getBestTweetsFromArchivedQuery(int(request.args.to_dict()['limit']), query)
+                tweets = getBestArchivedTweets(int(request.args.to_dict()['limit']), query)
 
                 for tweet in tweets:
                     response.append(tweet.getJSON())
@@ -351,7 +644,7 @@ def getTweetsFromArchivedQuery(id):
                 return {
                     'status': 200,
                     'message': 'Successfully retrieved tweets',
-                    'tweets': response
+                    'tweets': db.resolveMedia(response)
                 }
             except:
                 return {
@@ -364,10 +657,11 @@ def getTweetsFromArchivedQuery(id):
     }
 
 @app.route('/query/<string:id>/geojson', methods=['GET'])
+@admission.limit('read')
 def getTweetsFromQueryGeoJSON(id):
     for query in queries:
         if query.id == ObjectId(id):
-            tweets = db.getBestTweetsFromQuery(query.maxTweets, query)
+            tweets = getBestTweets(query.maxTweets, query)
             response = {
                 'type': 'FeatureCollection',
                 'features': []
@@ -392,10 +686,11 @@ def getTweetsFromQueryGeoJSON(id):
     }
 
 @app.route('/query/archive/<string:id>/geojson', methods=['GET'])
+@admission.limit('read')
 def getTweetsFromArchivedQueryGeoJSON(id):
     for query in archivedQueries:
         if query.id == ObjectId(id):
-            tweets = db.getBestTweetsFromArchivedQuery(query.maxTweets, query)
+            tweets = getBestArchivedTweets(query.maxTweets, query)
             response = {
                 'type': 'FeatureCollection',
                 'features': []
@@ -419,7 +714,113 @@ def getTweetsFromArchivedQueryGeoJSON(id):
         'message': 'Query not found'
     }
 
+# Compute the histogram of a query from the database
+def readHistogram(query, bucket):
+    unit, binSize = histogramBuckets[bucket]
+    return [{
+        'start': entry['start'].isoformat(),
+        'count': entry['count'],
+        'engagement': entry['engagement'],
+        'maxRs': entry['maxRs']
+    } for entry in db.getTweetHistogram(query, unit, binSize)]
+
+# Get the histogram of a query from the cache, computing it if needed
+def getHistogramResponse(query):
+    bucket = request.args.to_dict().get('bucket', 'hour')
+    if bucket not in histogramBuckets:
+        return {
+            'status': 400,
+            'message': 'Bucket must be one of ' + ', '.join(histogramBuckets)
+        }
+
+    histogram = tweetCache.getHistogram(query, bucket, readHistogram)
+
+    return {
+        'status': 200,
+        'message': 'Successfully retrieved histogram',
+        'bucket': bucket,
+        'histogram': histogram
+    }
+
+@app.route('/query/<string:id>/histogram', methods=['GET'])
+@admission.limit('read')
+def getHistogramFromQuery(id):
+    for query in queries:
+        if query.id == ObjectId(id):
+            try:
+                return getHistogramResponse(query)
+            except:
+                return {
+                    'status': 500,
+                    'message': 'Error retrieving histogram'
+                }
+    return {
+        'status': 500,
+        'message': 'Query not found'
+    }
+
+@app.route('/query/archive/<string:id>/histogram', methods=['GET'])
+@admission.limit('read')
+def getHistogramFromArchivedQuery(id):
+    for query in archivedQueries:
+        if query.id == ObjectId(id):
+            try:
+                return getHistogramResponse(query)
+            except:
+                return {
+                    'status': 500,
+                    'message': 'Error retrieving histogram'
+                }
+    return {
+        'status': 500,
+        'message': 'Archived query not found'
+    }
+
+# Route to list the unique media of a query, ranked by the best score of any tweet carrying it
+@app.route('/query/<string:id>/media', methods=['GET'])
+@admission.limit('read')
+def getMediaFromQuery(id):
+    for query in queries:
+        if query.id == ObjectId(id):
+            try:
+                return {
+                    'status': 200,
+                    'message': 'Successfully retrieved media',
+                    'media': db.getBestMediaFromQuery(int(request.args.to_dict().get('limit', 50)), query)
+                }
+            except:
+                return {
+                    'status': 500,
+                    'message': 'Error retrieving media'
+                }
+    return {
+        'status': 500,
+        'message': 'Query not found'
+    }
+
+@app.route('/query/archive/<string:id>/media', methods=['GET'])
+@admission.limit('read')
+def getMediaFromArchivedQuery(id):
+    for query in archivedQueries:
+        if query.id == ObjectId(id):
+            try:
+                return {
+                    'status': 200,
+                    'message': 'Successfully retrieved media',
+                    'media': db.getBestMediaFromQuery(int(request.args.to_dict().get('limit', 50)), query)
+                }
+            except:
+                return {
+                    'status': 500,
+                    'message': 'Error retrieving media'
+                }
+    return {
+        'status': 500,
+        'message': 'Archived query not found'
+    }
+
 @app.route('/queries/active/list/geojson', methods=['GET'])
+@admission.limit('aggregate')
 def getGeoJSONFromAllActiveQueries():
     response = {
         'type': 'FeatureCollection',
@@ -427,7 +828,7 @@ def getGeoJSONFromAllActiveQueries():
     }
     for query in queries:
         try:
-            tweets = db.getBestTweetsFromQuery(query.maxTweets, query)
+            tweets = getBestTweets(query.maxTweets, query)
         except:
             return {
                 'status': 500,
@@ -451,6 +852,7 @@ def getGeoJSONFromAllActiveQueries():
 
 # No current utility, can be used to create HeatMap of all archived queries
 @app.route('/queries/archive/list/geojson', methods=['GET'])
+@admission.limit('aggregate')
 def getGeoJSONFromAllArchivedQueries():
     response = {
         'type': 'FeatureCollection',
@@ -458,7 +860,7 @@ def getGeoJSONFromAllArchivedQueries():
     }
     for query in queries:
         try:
-            tweets = db.getBestTweetsFromArchivedQuery(query.maxTweets, query)
+            tweets = getBestArchivedTweets(query.maxTweets, query)
         except:
             return {
                 'status': 500,
@@ -480,8 +882,7 @@ def getGeoJSONFromAllArchivedQueries():
         'geojson': response
     }
     
-@app.route('/queries/archive/public/list/geojson', methods=['GET'])
-def getGeoJSONFromAllPublicQueries():
+def buildGeoJSONFromAllPublicQueries():
     response = {
         'type': 'FeatureCollection',
         'features': []
@@ -489,7 +890,7 @@ def getGeoJSONFromAllPublicQueries():
     for query in archivedQueries:
         if query.isPublic == True:    
             try:
-                tweets = db.getBestTweetsFromArchivedQuery(query.maxTweets, query)
+                tweets = getBestArchivedTweets(query.maxTweets, query)
             except:
                 return {
                     'status': 500,
@@ -511,12 +912,29 @@ def getGeoJSONFromAllPublicQueries():
         'geojson': response
     }
 
+# Share one computation of a public response between concurrent requests, only admitting the one that computes it
+# Kept results are also encoded once per format and content encoding
+def getPublicResponse(key, build):
+    try:
+        response = publicResponses.do(key, admission.limit('aggregate')(build))
+    except TimeoutError:
+        return admission.getBusyResponse()
+    if publicResponses.keep(response):
+        return encodedPublicResponses.get(request, key, response)
+    return response
+
+# Concurrent requests share one computation, as public links are often opened all at once
+@app.route('/queries/archive/public/list/geojson', methods=['GET'])
+def getGeoJSONFromAllPublicQueries():
+    return getPublicResponse(('geojson',), buildGeoJSONFromAllPublicQueries)
+
 @app.route('/queries/active/list/tweets', methods=['GET'])
+@admission.limit('aggregate')
 def getTweetsFromAllActiveQueries():
     response = []
     for query in queries:
         try:
-            tweets = db.getBestTweetsFromQuery(query.maxTweets, query)
+            tweets = getBestTweets(query.maxTweets, query)
         except:
             return {
                 'status': 500,
@@ -533,15 +951,16 @@ def getTweetsFromAllActiveQueries():
     return {
         'status': 200,
         'message': 'Successfully retrieved tweets',
-        'tweets': response
+        'tweets': db.resolveMedia(response)
     }
 
 @app.route('/queries/archive/list/tweets', methods=['GET'])
+@admission.limit('aggregate')
 def getTweetsFromAllArchivedQueries():
     response = []
     for query in archivedQueries:
         try:
-            tweets = db.getBestTweetsFromArchivedQuery(query.maxTweets, query)
+            tweets = getBestArchivedTweets(query.maxTweets, query)
         except:
             return {
                 'status': 500,
@@ -558,16 +977,15 @@ def getTweetsFromAllArchivedQueries():
     return {
         'status': 200,
         'message': 'Successfully retrieved tweets',
-        'tweets': response
+        'tweets': db.resolveMedia(response)
     }
 
-@app.route('/queries/archive/public/list/tweets', methods=['GET'])
-def getTweetsFromAllPublicQueries():
+def buildTweetsFromAllPublicQueries(limit):
     response = []
     for query in archivedQueries:
         if (query.isPublic == True):
             try:
-                tweets = db.getBestTweetsFromArchivedQuery(query.maxTweets, query)
+                tweets = getBestArchivedTweets(query.maxTweets, query)
             except:
                 return {
                     'status': 500,
@@ -577,16 +995,195 @@ def getTweetsFromAllPublicQueries():
                 response.append(tweet.getJSON())
     response.sort(key=lambda x: x['rs'], reverse=True)
 
-    if (request.args.to_dict()['limit'] != None):
-        response = response[:int(request.args.to_dict()['limit'])]
+    if (limit != None):
+        response = response[:int(limit)]
+
+    return {
+        'status': 200,
+        'message': 'Successfully retrieved tweets',
+        'tweets': db.resolveMedia(response)
+    }
+
+@app.route('/queries/archive/public/list/tweets', methods=['GET'])
+def getTweetsFromAllPublicQueries():
+    limit = request.args.to_dict()['limit']
+    return getPublicResponse(('tweets', limit), lambda: buildTweetsFromAllPublicQueries(limit))
+
+
+
+@app.route('/tweets/near', methods=['GET'])
+@admission.limit('aggregate')
+def getTweetsNear():
+    args = request.args.to_dict()
+    try:
+        tweets = db.getBestTweetsNear(int(args.get('limit', 100)), float(args['lon']), float(args['lat']), float(args['radius']))
+    except:
+        return {
+            'status': 500,
+            'message': 'Error retrieving tweets, check the arguments'
+        }
+
+    return {
+        'status': 200,
+        'message': 'Successfully retrieved tweets',
+        'tweets': db.resolveMedia([tweet.getJSON() for tweet in tweets])
+    }
+
+# The bounding box is given as minLon,minLat,maxLon,maxLat
+@app.route('/tweets/within', methods=['GET'])
+@admission.limit('aggregate')
+def getTweetsWithin():
+    args = request.args.to_dict()
+    try:
+        minLongitude, minLatitude, maxLongitude, maxLatitude = [float(x) for x in args['bbox'].split(',')]
+        tweets = db.getBestTweetsWithin(int(args.get('limit', 100)), minLongitude, minLatitude, maxLongitude, maxLatitude)
+    except:
+        return {
+            'status': 500,
+            'message': 'Error retrieving tweets, check the arguments'
+        }
+
+    return {
+        'status': 200,
+        'message': 'Successfully retrieved tweets',
+        'tweets': db.resolveMedia([tweet.getJSON() for tweet in tweets])
+    }
+
+# Search the content of tweets, optionally filtered by query IDs, date range (YYYY-MM-DD) and minimum score
+@app.route('/tweets/search', methods=['GET'])
+@admission.limit('aggregate')
+def searchTweets():
+    args = request.args.to_dict()
+    try:
+        queryIds = None
+        if 'query' in args:
+            queryIds = [ObjectId(id) for id in args['query'].split(',') if id != '']
+
+        startDate = None
+        if 'start' in args:
+            startDate = datetime.datetime.strptime(args['start'], '%Y-%m-%d')
+
+        endDate = None
+        if 'end' in args:
+            endDate = datetime.datetime.strptime(args['end'], '%Y-%m-%d').replace(hour=23, minute=59, second=59, microsecond=0)
+
+        minScore = None
+        if 'minRs' in args:
+            minScore = float(args['minRs'])
+
+        page = int(args.get('page', 1))
+        limit = int(args.get('limit', 50))
+        tweets = db.searchTweets(args['q'], queryIds, startDate, endDate, minScore, (page - 1) * limit, limit)
+    except:
+        return {
+            'status': 500,
+            'message': 'Error searching tweets, check the arguments'
+        }
 
     return {
         'status': 200,
         'message': 'Successfully retrieved tweets',
-        'tweets': response
+        'page': page,
+        'tweets': db.resolveMedia([tweet.getJSON() for tweet in tweets])
+    }
+
+# Route to see how the scrape jobs are being rate limited
+@app.route('/scraper/stats', methods=['GET'])
+def getScraperStats():
+    return {
+        'status': 200,
+        'message': 'Successfully retrieved scraper stats',
+        'stats': scrapeLimiter.getStats()
+    }
+
+# Route to see the biggest sources of allocated memory and how they changed since the last call
+@app.route('/admin/profile/memory', methods=['GET'])
+@profiler.guard
+def getMemoryProfile():
+    memory = profiler.takeSnapshot(int(request.args.to_dict().get('limit', 25)))
+    if memory is None:
+        return {
+            'status': 500,
+            'message': 'Memory tracing is off, start it with POST /admin/profile/memory/start'
+        }
+    return {
+        'status': 200,
+        'message': 'Successfully took memory snapshot',
+        'memory': memory
+    }
+
+# Route to start tracing memory allocations, optionally keeping ?frames= frames of each traceback
+@app.route('/admin/profile/memory/start', methods=['POST'])
+@profiler.guard
+def startMemoryProfile():
+    frames = request.args.to_dict().get('frames')
+    profiler.startTracing(int(frames) if frames is not None else None)
+    return {
+        'status': 200,
+        'message': 'Successfully started tracing memory'
+    }
+
+# Route to stop tracing memory allocations, as tracing slows every request and job down
+@app.route('/admin/profile/memory/stop', methods=['POST'])
+@profiler.guard
+def stopMemoryProfile():
+    profiler.stopTracing()
+    return {
+        'status': 200,
+        'message': 'Successfully stopped tracing memory'
+    }
+
+# Route to see the duration and peak memory of each query's last fetch
+@app.route('/admin/profile/jobs', methods=['GET'])
+@profiler.guard
+def getJobProfiles():
+    return {
+        'status': 200,
+        'message': 'Successfully retrieved job profiles',
+        'jobs': profiler.getJobStats()
+    }
+
+# Route to profile the next fetch of a query, which is run by the scheduler as soon as possible
+@app.route('/admin/profile/query/<string:id>', methods=['POST'])
+@profiler.guard
+def profileQuery(id):
+    for query in queries:
+        if query.id == ObjectId(id):
+            profiler.requestProfile(query.id)
+
+            # A fetch that is already running keeps going, and the one after it is profiled instead
+            sched.modify_job(str(query.id), next_run_time=datetime.datetime.now(datetime.timezone.utc))
+            return {
+                'status': 202,
+                'message': 'Query will be profiled on its next fetch'
+            }, 202
+    return {
+        'status': 500,
+        'message': 'Query not found'
     }
 
+# Route to get the CPU profile of the last profiled fetch of a query
+@app.route('/admin/profile/query/<string:id>', methods=['GET'])
+@profiler.guard
+def getQueryProfile(id):
+    return {
+        'status': 200,
+        'message': 'Successfully retrieved query profile',
+        'profile': profiler.getProfile(ObjectId(id))
+    }
 
+# Route to call another GET route once under the CPU profiler, e.g. ?path=/queries/active/list/tweets?limit=10
+@app.route('/admin/profile/route', methods=['GET'])
+@profiler.guard
+def profileRoute():
+    path = request.args.to_dict()['path']
+    response, profile = profiler.profileCallLocked(app.test_client().get, path)
+    return {
+        'status': 200,
+        'message': 'Successfully profiled route',
+        'routeStatus': response.status_code,
+        'profile': profile
+    }
 
 @app.route('/queries/active/list', methods=['GET'])
 def getActiveQueries():
@@ -0,0 +1,162 @@
+import cProfile
+import functools
+import hmac
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+from flask import request
+
+# Opt-in memory and CPU profiling, only enabled when an admin token is configured
+class Profiler():
+    def __init__(self, token, frames=10):
+        self.token = token
+        self.enabled = token is not None and token != ''
+        self.frames = frames
+        self.lock = threading.Lock()
+        self.lastSnapshot = None
+
+        # Runs, durations and peak traced memory of each tracked job, per query ID
+        self.jobs = {}
+
+        # Number of tracked jobs running, the peak is only reset when a job starts alone
+        self.activeJobs = 0
+
+        # Query IDs whose next run is profiled, and the last CPU profile of each query
+        self.pending = set()
+        self.profiles = {}
+
+        # Only one CPU profiler can run at a time
+        self.profileLock = threading.Lock()
+
+    def isAuthorized(self, request):
+        return self.enabled and hmac.compare_digest(request.headers.get('X-Profiling-Token', ''), self.token)
+
+    # Decorator rejecting requests without the profiling token
+    def guard(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.isAuthorized(request):
+                return {
+                    'status': 403,
+                    'message': 'Profiling is disabled or the token is invalid'
+                }, 403
+            return fn(*args, **kwargs)
+        return wrapper
+
+    # Allocation tracing slows the whole process down, so it only runs between these calls
+    def startTracing(self, frames=None):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames if frames is not None else self.frames)
+                self.lastSnapshot = None
+
+    def stopTracing(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.lastSnapshot = None
+
+    # Decorator recording the duration and peak memory of a job taking a query as its first argument, and profiling it if requested
+    # The peak is process wide and isn't reset while another job runs, so it is an upper bound including anything that ran at the same time
+    def track(self, fn):
+        @functools.wraps(fn)
+        def wrapper(query, *args, **kwargs):
+            if not self.enabled:
+                return fn(query, *args, **kwargs)
+
+            with self.lock:
+                self.activeJobs += 1
+                if self.activeJobs == 1 and tracemalloc.is_tracing():
+                    tracemalloc.reset_peak()
+            start = time.monotonic()
+            try:
+                if self.takePending(query.id):
+                    try:
+                        result, profile = self.profileCall(fn, query, *args, **kwargs)
+                    finally:
+                        self.profileLock.release()
+                    with self.lock:
+                        self.profiles[str(query.id)] = {'time': time.time(), 'profile': profile}
+                    return result
+                return fn(query, *args, **kwargs)
+            finally:
+                duration = time.monotonic() - start
+                with self.lock:
+                    self.activeJobs -= 1
+
+                    # Runs while memory isn't traced only record their duration
+                    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+                    job = self.jobs.setdefault(str(query.id), {'runs': 0, 'lastDuration': 0, 'lastProcessPeak': None, 'maxProcessPeak': None})
+                    job['runs'] += 1
+                    job['lastDuration'] = duration
+                    job['lastProcessPeak'] = peak
+                    if peak is not None:
+                        job['maxProcessPeak'] = max(job['maxProcessPeak'] or 0, peak)
+        return wrapper
+
+    # Profile the next run of a query's job
+    def requestProfile(self, queryId):
+        with self.lock:
+            self.pending.add(str(queryId))
+
+    # Check if a run should be profiled, taking the profiler lock if so, or leaving it pending while another profile runs
+    def takePending(self, queryId):
+        with self.lock:
+            if str(queryId) not in self.pending or not self.profileLock.acquire(blocking=False):
+                return False
+            self.pending.discard(str(queryId))
+            return True
+
+    def getProfile(self, queryId):
+        with self.lock:
+            profile = self.profiles.get(str(queryId))
+            return {
+                'pending': str(queryId) in self.pending,
+                'time': profile['time'] if profile is not None else None,
+                'profile': profile['profile'] if profile is not None else None
+            }
+
+    def getJobStats(self):
+        with self.lock:
+            return {id: dict(job) for id, job in self.jobs.items()}
+
+    # Take a snapshot of traced allocations, with the biggest sources and the change since the last snapshot, or None if tracing is off
+    def takeSnapshot(self, limit=25):
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+
+        with self.lock:
+            lastSnapshot = self.lastSnapshot
+            self.lastSnapshot = snapshot
+
+        diff = []
+        if lastSnapshot is not None:
+            diff = [str(stat) for stat in snapshot.compare_to(lastSnapshot, 'lineno')[:limit]]
+
+        return {
+            'current': current,
+            'peak': peak,
+            'top': [str(stat) for stat in snapshot.statistics('lineno')[:limit]],
+            'diff': diff
+        }
+
+    # Run a function under the CPU profiler, returning its result and the profile sorted by cumulative time
+    def profileCall(self, fn, *args, limit=40, **kwargs):
+        profile = cProfile.Profile()
+        result = profile.runcall(fn, *args, **kwargs)
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(limit)
+        return result, output.getvalue()
+
+    # Run a function under the CPU profiler once no other profile is running
+    def profileCallLocked(self, fn, *args, limit=40, **kwargs):
+        with self.profileLock:
+            return self.profileCall(fn, *args, limit=limit, **kwargs)
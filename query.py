@@ -1,3 +1,5 @@
+import sys
+
 class Query():
     def __init__(self, name, location, startDate, endDate, keywords, frequency, maxTweets):
         self.id = None
@@ -9,6 +11,22 @@ class Query():
         self.frequency = frequency
         self.maxTweets = maxTweets
 
+        # Parse the "lat,lon,radius" geocode once into a GeoJSON point, which is [lon, lat]
+        # A malformed location only leaves tweets without a fallback location, rather than failing to load every query
+        try:
+            latitude, longitude = location.split(',')[:2]
+            self.point = {
+                'type': 'Point',
+                'coordinates': [float(longitude), float(latitude)]
+            }
+        except (AttributeError, ValueError):
+            self.point = None
+            print(f'🛑 Query {name} has a malformed location: {str(location)}', file=sys.stderr)
+
+    # Format the keywords as a search query
+    def getKeywordQuery(self):
+        return ' OR '.join(self.keywords)
+
     def getDict(self):
         if self.id is None:
             return {
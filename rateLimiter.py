@@ -0,0 +1,75 @@
+import collections
+import random
+import threading
+import time
+
+# Token bucket shared by all scrape jobs, serving waiting jobs in order so each query gets its turn
+class RateLimiter():
+    def __init__(self, rate, capacity, minRate=0.05, maxBackoff=300):
+        self.condition = threading.Condition()
+        self.baseRate = rate
+        self.rate = rate
+        self.minRate = minRate
+        self.capacity = capacity
+        self.maxBackoff = maxBackoff
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiting = collections.deque()
+
+        # Requests, retries and seconds spent waiting for tokens or backing off, per query ID
+        self.stats = {}
+
+    def getQueryStats(self, queryId):
+        return self.stats.setdefault(queryId, {'requests': 0, 'retries': 0, 'throttledSeconds': 0})
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Wait until the query may make a request
+    def acquire(self, queryId):
+        ticket = object()
+        start = time.monotonic()
+        with self.condition:
+            self.waiting.append(ticket)
+            while True:
+                self.refill()
+                if self.waiting[0] is ticket and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.waiting.popleft()
+                    self.condition.notify_all()
+                    break
+
+                # The next in line sleeps until a token is due, the others until they are next
+                if self.waiting[0] is ticket:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.condition.wait()
+
+            stats = self.getQueryStats(queryId)
+            stats['requests'] += 1
+            stats['throttledSeconds'] += time.monotonic() - start
+
+    # Back off after a failed request, returning how long to wait, and slow down if the upstream throttled it
+    def failed(self, queryId, attempt, throttled):
+        with self.condition:
+            if throttled:
+                self.rate = max(self.minRate, self.rate / 2)
+            delay = min(self.maxBackoff, (2 ** attempt) * (1 + random.random()))
+            stats = self.getQueryStats(queryId)
+            stats['retries'] += 1
+            stats['throttledSeconds'] += delay
+        return delay
+
+    # Speed back up gradually after a successful request
+    def succeeded(self):
+        with self.condition:
+            self.rate = min(self.baseRate, self.rate + self.baseRate / 10)
+
+    def getStats(self):
+        with self.condition:
+            return {
+                'rate': self.rate,
+                'queries': {str(queryId): dict(stats) for queryId, stats in self.stats.items()}
+            }
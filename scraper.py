@@ -0,0 +1,40 @@
+import snscrape.base
+import snscrape.modules.twitter as sntwitter
+import time
+
+# Status codes with which Twitter asks clients to slow down
+throttleStatuses = (429, 503)
+
+# Twitter search scraper whose requests go through a shared rate limiter, backing off when they fail
+class LimitedSearchScraper(sntwitter.TwitterSearchScraper):
+    def __init__(self, query, limiter, queryId, maxRetries=5, **kwargs):
+        # Retry here rather than in snscrape, so every attempt takes a token from the limiter
+        kwargs.setdefault('retries', 0)
+        super().__init__(query, **kwargs)
+        self.limiter = limiter
+        self.queryId = queryId
+        self.maxRetries = maxRetries
+
+    def _request(self, *args, responseOkCallback=None, **kwargs):
+        status = {'code': None}
+
+        # Record the status of the last response, so only throttling slows every job down
+        def checkResponse(r):
+            status['code'] = r.status_code
+            if responseOkCallback is None:
+                return True, None
+            return responseOkCallback(r)
+
+        attempt = 0
+        while True:
+            self.limiter.acquire(self.queryId)
+            status['code'] = None
+            try:
+                response = super()._request(*args, responseOkCallback=checkResponse, **kwargs)
+                self.limiter.succeeded()
+                return response
+            except snscrape.base.ScraperException:
+                if attempt >= self.maxRetries:
+                    raise
+                time.sleep(self.limiter.failed(self.queryId, attempt, status['code'] in throttleStatuses))
+                attempt += 1
@@ -0,0 +1,79 @@
+import threading
+import time
+
+class Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.expires = None
+
+# Shares one computation between concurrent identical requests, then keeps the result for a few seconds
+class SingleFlight():
+    def __init__(self, ttl=5, keep=None, timeout=None, maxWaiters=None):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+
+        # Seconds a request waits for another's result, and how many may wait at once for any key, before giving up with a TimeoutError
+        self.timeout = timeout
+        self.maxWaiters = maxWaiters
+        self.waiters = 0
+        self.calls = {}
+
+        # Decides which results are kept, e.g. only successful responses, all of them when None
+        self.keep = keep
+
+    def do(self, key, fn):
+        waiting = False
+        with self.lock:
+            now = time.monotonic()
+            call = self.calls.get(key)
+            leader = call is None or (call.expires is not None and call.expires <= now)
+            if leader:
+                # Drop expired results so the cache doesn't grow with every distinct key
+                for expiredKey in [k for k, c in self.calls.items() if c.expires is not None and c.expires <= now]:
+                    del self.calls[expiredKey]
+                call = Call()
+                self.calls[key] = call
+            elif not call.done.is_set():
+                if self.maxWaiters is not None and self.waiters >= self.maxWaiters:
+                    raise TimeoutError(f'Too many requests waiting for {key}')
+                self.waiters += 1
+                waiting = True
+
+        if not leader:
+            try:
+                finished = call.done.wait(self.timeout) if waiting else True
+            finally:
+                if waiting:
+                    with self.lock:
+                        self.waiters -= 1
+            if not finished:
+                raise TimeoutError(f'Timed out waiting for {key}')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            call.expires = time.monotonic() + self.ttl
+
+            # Results that aren't kept are still shared with the requests already waiting for them
+            if call.error is not None or (self.keep is not None and not self.keep(call.result)):
+                self.discard(key, call)
+            call.done.set()
+        return call.result
+
+    def discard(self, key, call):
+        with self.lock:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+
+    # Drop all kept results, e.g. when the data behind them changes
+    def forget(self):
+        with self.lock:
+            self.calls = {}
@@ -0,0 +1,108 @@
+import collections
+import threading
+
+class TweetCache():
+    def __init__(self, maxQueries=50):
+        self.lock = threading.Lock()
+        self.maxQueries = maxQueries
+
+        # Maps a query ID to its top tweets, sorted by relatability score, least recently used first
+        self.tweets = collections.OrderedDict()
+
+        # Maps a query ID and bucket to the histogram of the query, least recently used first
+        self.histograms = collections.OrderedDict()
+
+        # Number of batches written per query, used to detect writes during a load
+        self.versions = {}
+
+    # Keep a query's tweets, evicting the least recently used queries past the limit
+    def store(self, queryId, tweets):
+        self.tweets[queryId] = tweets
+        self.tweets.move_to_end(queryId)
+        while len(self.tweets) > self.maxQueries:
+            self.tweets.popitem(last=False)
+
+    # Load the top tweets of a query from the database on first use
+    def load(self, query, read):
+        with self.lock:
+            version = self.versions.get(query.id, 0)
+
+        tweets = read(query.maxTweets, query)
+
+        with self.lock:
+            # Only keep the result if no batch was written while it was being read
+            if self.versions.get(query.id, 0) == version:
+                if query.id not in self.tweets:
+                    self.store(query.id, tweets)
+                return self.tweets[query.id]
+        return tweets
+
+    # Merge a freshly scored batch into the top tweets of a query
+    def update(self, query, tweets):
+        with self.lock:
+            self.versions[query.id] = self.versions.get(query.id, 0) + 1
+            self.dropHistograms(query.id)
+            if query.id not in self.tweets:
+                return
+
+            # Re-scored tweets replace their previous entry
+            merged = {tweet.id: tweet for tweet in self.tweets[query.id]}
+            for tweet in tweets:
+                # A tweet scored lower may fall out of the top tweets, and only the database knows which one replaces it
+                if tweet.id in merged and tweet.relatabilityScore < merged[tweet.id].relatabilityScore:
+                    self.tweets.pop(query.id)
+                    return
+                merged[tweet.id] = tweet
+
+            best = sorted(merged.values(), key=lambda x: x.relatabilityScore, reverse=True)
+            self.store(query.id, best[:query.maxTweets])
+
+    # Get the best tweets of a query, using read(max, query) when more are requested than are kept
+    def get(self, max, query, read):
+        if max == 0 or max > query.maxTweets:
+            return read(max, query)
+
+        with self.lock:
+            tweets = self.tweets.get(query.id)
+            if tweets is not None:
+                self.tweets.move_to_end(query.id)
+        if tweets is None:
+            tweets = self.load(query, read)
+        return tweets[:max]
+
+    # Get the histogram of a query for a bucket, using read(query, bucket) until the next batch is written
+    def getHistogram(self, query, bucket, read):
+        with self.lock:
+            histogram = self.histograms.get((query.id, bucket))
+            if histogram is not None:
+                self.histograms.move_to_end((query.id, bucket))
+                return histogram
+            version = self.versions.get(query.id, 0)
+
+        histogram = read(query, bucket)
+
+        with self.lock:
+            # Histograms are kept under the same limit as queries, as those of long events can be large
+            if self.versions.get(query.id, 0) == version:
+                self.histograms[(query.id, bucket)] = histogram
+                self.histograms.move_to_end((query.id, bucket))
+                while len(self.histograms) > self.maxQueries:
+                    self.histograms.popitem(last=False)
+        return histogram
+
+    def dropHistograms(self, queryId):
+        for key in [key for key in self.histograms if key[0] == queryId]:
+            del self.histograms[key]
+
+    # Drop the tweets and histograms of a query, e.g. after they were written by another process
+    def invalidate(self, queryId):
+        with self.lock:
+            self.tweets.pop(queryId, None)
+            self.dropHistograms(queryId)
+            self.versions[queryId] = self.versions.get(queryId, 0) + 1
+
+    def remove(self, query):
+        with self.lock:
+            self.tweets.pop(query.id, None)
+            self.dropHistograms(query.id)
+            self.versions.pop(query.id, None)
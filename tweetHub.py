@@ -0,0 +1,104 @@
+import json
+import queue
+import threading
+import time
+
+# Iterable Server-Sent Events body, which unsubscribes when the server closes it even if it was never read
+class LiveStream():
+    def __init__(self, hub, queryId, messages):
+        self.hub = hub
+        self.queryId = queryId
+        self.messages = messages
+        self.expires = time.monotonic() + hub.maxLifetime
+        self.started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.started:
+            # Tell clients how long to wait before reconnecting once the stream ends
+            self.started = True
+            return f'retry: {str(self.hub.retry * 1000)}\n: connected\n\n'
+
+        remaining = self.expires - time.monotonic()
+        if remaining <= 0:
+            raise StopIteration
+        try:
+            return self.messages.get(timeout=min(self.hub.keepAlive, remaining))
+        except queue.Empty:
+            return ': keep-alive\n\n'
+
+    def close(self):
+        self.hub.unsubscribe(self.queryId, self.messages)
+
+# Fans out newly scored tweets to every client streaming a query, or all active queries
+# Each stream holds a server thread, so only maxStreams may be open at once and each ends after maxLifetime seconds
+class TweetHub():
+    def __init__(self, maxStreams=32, maxLifetime=300, retry=5, maxQueued=100, keepAlive=15, resolve=None):
+        self.lock = threading.Lock()
+        self.maxStreams = maxStreams
+        self.maxLifetime = maxLifetime
+        self.retry = retry
+        self.maxQueued = maxQueued
+        self.keepAlive = keepAlive
+        self.streams = 0
+
+        # Completes the JSON of published tweets, only called when someone is listening
+        self.resolve = resolve
+
+        # Maps a query ID, or None for all queries, to the message queues of its subscribers
+        self.subscribers = {}
+
+    # Get the message queue of a new subscriber, or None if too many streams are open
+    def subscribe(self, queryId=None):
+        messages = queue.Queue(maxsize=self.maxQueued)
+        with self.lock:
+            if self.streams >= self.maxStreams:
+                return None
+            self.streams += 1
+            self.subscribers.setdefault(queryId, set()).add(messages)
+        return messages
+
+    def unsubscribe(self, queryId, messages):
+        with self.lock:
+            subscribers = self.subscribers.get(queryId)
+            if subscribers is not None and messages in subscribers:
+                subscribers.discard(messages)
+                self.streams -= 1
+                if len(subscribers) == 0:
+                    del self.subscribers[queryId]
+
+    def publish(self, queryId, tweets):
+        with self.lock:
+            subscribers = list(self.subscribers.get(queryId, ())) + list(self.subscribers.get(None, ()))
+        if len(subscribers) == 0:
+            return
+
+        tweetJSONs = [tweet.getJSON() for tweet in tweets]
+        if self.resolve is not None:
+            tweetJSONs = self.resolve(tweetJSONs)
+
+        # Encode the event once and share it with every subscriber
+        message = 'event: tweets\ndata: ' + json.dumps({
+            'qId': str(queryId),
+            'tweets': tweetJSONs
+        }) + '\n\n'
+
+        for messages in subscribers:
+            try:
+                messages.put_nowait(message)
+            except queue.Full:
+                # Drop the oldest event for clients that aren't keeping up
+                try:
+                    messages.get_nowait()
+                    messages.put_nowait(message)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    # Server-Sent Events stream for a query, or for all queries when queryId is None, or None if too many are open
+    def stream(self, queryId=None):
+        messages = self.subscribe(queryId)
+        if messages is None:
+            return None
+        return LiveStream(self, queryId, messages)
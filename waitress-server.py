@@ -1,5 +1,6 @@
 from waitress import serve
 import main
+import os
 
-# Serve the app using WSGI server
-serve(main.app, host='0.0.0.0', port=8080)
\ No newline at end of file
+# Serve the app using WSGI server, with enough threads for cheap routes to get through while expensive ones are limited
+serve(main.app, host='0.0.0.0', port=8080, threads=int(os.environ.get("SERVER_THREADS", 48)))
\ No newline at end of file